@@ -1,23 +1,29 @@
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel, Field
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
-from io import BytesIO
-import torch, httpx
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+import asyncio, os
+import httpx
+from model import preproc, generate_captions
 
 async def lifespan(app):
     app.state.http = httpx.AsyncClient(
-        timeout=httpx.Timeout(10.0),
+        http2=True,
+        timeout=httpx.Timeout(5.0, connect=2.0),
         limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
     )
+    app.state.caption_queue = asyncio.Queue()
+    app.state.gpu_sem = asyncio.Semaphore(int(os.getenv("GPU_CONCURRENCY", "2")))
+    batcher = asyncio.create_task(caption_batcher(app.state.caption_queue, app.state.gpu_sem))
     yield
+    batcher.cancel()
     await app.state.http.aclose()
 
 app = FastAPI(
     title="Image Captioning Service",
     description="A FastAPI service for generating image captions using a pre-trained BLIP model.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan,
     docs_url="/caption/docs",
     redoc_url="/caption/redoc",
@@ -25,28 +31,71 @@ app = FastAPI(
 )
 
 class ImageReq(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     image_url: str = Field(description="Image URL")
 
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-captioning_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-captioning_model.to(device)
+# micro-batching: concurrent requests within MAX_WAIT_MS share one generate call
+MAX_BATCH_SIZE = int(os.getenv("CAPTION_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.getenv("CAPTION_MAX_WAIT_MS", "10"))
 
+async def run_caption_batch(batch: list, gpu_sem: asyncio.Semaphore):
+    try:
+        captions = await asyncio.to_thread(generate_captions, [image for image, _ in batch])
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    finally:
+        gpu_sem.release()
+    for (_, future), caption in zip(batch, captions):
+        if not future.done():
+            future.set_result(caption)
 
-def preproc(image_bytes: bytes) -> Image.Image:
-    image = Image.open(BytesIO(image_bytes)).convert("RGB")
-    return image
+async def caption_batcher(queue: asyncio.Queue, gpu_sem: asyncio.Semaphore):
+    loop = asyncio.get_running_loop()
+    running = set()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
 
-def generate_caption(image: Image.Image) -> str:
-    inputs = processor(image, return_tensors="pt").to(device)
-    with torch.no_grad():
-        out = captioning_model.generate(**inputs)
-    caption = processor.decode(out[0], skip_special_tokens=True)
-    return caption
+        batch = [(image, future) for image, future in batch if not future.cancelled()]
+        if not batch:
+            continue
+        # generate runs in a worker thread; at most GPU_CONCURRENCY batches are in flight
+        await gpu_sem.acquire()
+        task = asyncio.create_task(run_caption_batch(batch, gpu_sem))
+        running.add(task)
+        task.add_done_callback(running.discard)
 
 class CaptionResp(BaseModel):
     caption: str = Field(description="Generated caption for the image")
 
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(8 * 1024 * 1024)))
+
+async def fetch_image(client: httpx.AsyncClient, url: str) -> bytes:
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        if not response.headers.get("content-type", "").startswith("image/"):
+            raise HTTPException(415, "Unsupported content-type")
+        if int(response.headers.get("content-length", 0)) > MAX_IMAGE_BYTES:
+            raise HTTPException(413, "Image too large")
+        content = bytearray()
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if len(content) > MAX_IMAGE_BYTES:
+                raise HTTPException(413, "Image too large")
+    return bytes(content)
+
 @app.post(
     "/caption/exec",
     summary="Generate image caption",
@@ -54,18 +103,20 @@ class CaptionResp(BaseModel):
     tags=["Image Captioning"],
     response_model=CaptionResp,
     responses={
+        413: {"description": "Image exceeds the maximum allowed size."},
         415: {"description": "Unsupported content-type. Only images are allowed."},
         500: {"description": "Internal server error while processing the image."}
     }
 )
 async def caption_image(request: Request, body: ImageReq):
     try:
-        response = await request.app.state.http.get(body.image_url)
-        response.raise_for_status()
-        if not response.headers.get("content-type", "").startswith("image/"):
-            raise HTTPException(415, "Unsupported content-type")
-        img = preproc(response.content)
-        caption = generate_caption(img)
+        image_bytes = await fetch_image(request.app.state.http, body.image_url)
+        img = await asyncio.to_thread(preproc, image_bytes)
+        future = asyncio.get_running_loop().create_future()
+        await request.app.state.caption_queue.put((img, future))
+        caption = await future
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {e}")
 
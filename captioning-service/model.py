@@ -0,0 +1,42 @@
+from transformers import BlipProcessor, BlipForConditionalGeneration
+from PIL import Image
+from io import BytesIO
+from typing import List
+import contextlib, os
+import torch
+
+processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+captioning_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+torch.set_num_threads(int(os.getenv("TORCH_THREADS", "4")))
+captioning_model.to(device)
+
+# DTYPE: fp32 (default) | int8 (dynamic quantization, CPU only) | fp16 | bf16 (autocast)
+DTYPE = os.getenv("DTYPE", "fp32")
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+if DTYPE not in ("fp32", "int8") and DTYPE not in AUTOCAST_DTYPES:
+    raise ValueError(f"Unsupported DTYPE: {DTYPE!r} (expected fp32, int8, fp16 or bf16)")
+if DTYPE == "int8" and device.type != "cpu":
+    raise ValueError("DTYPE=int8 uses CPU dynamic quantization; use fp16 or bf16 on CUDA")
+
+if DTYPE == "int8":
+    captioning_model = torch.ao.quantization.quantize_dynamic(
+        captioning_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+def autocast():
+    if DTYPE in AUTOCAST_DTYPES:
+        return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[DTYPE])
+    return contextlib.nullcontext()
+
+def preproc(image_bytes: bytes) -> Image.Image:
+    image = Image.open(BytesIO(image_bytes))
+    # JPEG only: decode at a reduced DCT scale that still covers BLIP's 384x384 input
+    image.draft("RGB", (384, 384))
+    return image.convert("RGB")
+
+def generate_captions(images: List[Image.Image]) -> List[str]:
+    inputs = processor(images, return_tensors="pt", padding=True).to(device)
+    with torch.inference_mode(), autocast():
+        out = captioning_model.generate(**inputs, num_beams=1)
+    return processor.batch_decode(out, skip_special_tokens=True)
@@ -1,27 +1,45 @@
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List
+import asyncio, contextlib, hashlib, os
+from concurrent.futures import ThreadPoolExecutor
 import httpx
+import onnxruntime as ort
 from io import BytesIO
 from PIL import Image
 import torch
 import torch.nn as nn
-from torchvision import transforms as T
+from torchvision.io import decode_jpeg, ImageReadMode
+from torchvision.transforms import v2
+from torchvision.transforms.functional import pil_to_tensor
 from torchvision.models import efficientnet_b0
 
 async def lifespan(app):
     app.state.http = httpx.AsyncClient(
-        timeout=httpx.Timeout(10.0),
+        http2=True,
+        timeout=httpx.Timeout(5.0, connect=2.0),
         limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
     )
+    app.state.classifier, app.state.ort_session = load_classifier()
+    gpu_concurrency = int(os.getenv("GPU_CONCURRENCY", "2"))
+    app.state.gpu_sem = asyncio.Semaphore(gpu_concurrency)
+    # forwards always run on these threads, and each one warms up (records its CUDA graphs) on start
+    app.state.gpu_executor = ThreadPoolExecutor(
+        max_workers=gpu_concurrency, initializer=warmup_model, initargs=(app.state.classifier,)
+    )
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(app.state.gpu_executor, int) for _ in range(gpu_concurrency)))
     yield
+    app.state.gpu_executor.shutdown()
     await app.state.http.aclose()
 
 app = FastAPI(
     title="Image Classification Service",
     description="A FastAPI service for classifying images using a pre-trained EfficientNet model.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan,
     docs_url="/classify/docs",
     redoc_url="/classify/redoc",
@@ -29,6 +47,8 @@ app = FastAPI(
 )
 
 class ImageReq(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     image_url: str = Field(description="Image URL")
 
 class AiPrediction(BaseModel):
@@ -124,13 +144,15 @@ CATEGORIES= [
 
 MODEL_PATH = "./models/model.pth"
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+torch.set_num_threads(int(os.getenv("TORCH_THREADS", "4")))
 
 # load efficientnet model
 def load_model(model_path: str, num_classes: int) -> nn.Module:
     model = efficientnet_b0(weights=None)
     num_ftrs = model.classifier[1].in_features
     model.classifier[1] = nn.Linear(num_ftrs, num_classes)
-    checkpoint = torch.load(model_path, map_location=device)
+    # mmap the checkpoint so only the pages actually read are faulted in
+    checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
     if 'model_state_dict' in checkpoint:
         model.load_state_dict(checkpoint['model_state_dict'])
     else:
@@ -139,62 +161,175 @@ def load_model(model_path: str, num_classes: int) -> nn.Module:
     model.eval()
     return model
 
-classifier = load_model(MODEL_PATH, num_classes=len(CATEGORIES))
+# DTYPE: auto (default: fp16 on CUDA, fp32 on CPU) | fp32 | fp16 | bf16 (autocast)
+# int8 is not offered: EfficientNet is conv-bound and dynamic quantization only covers nn.Linear.
+DTYPE = os.getenv("DTYPE", "auto")
+if DTYPE == "auto":
+    DTYPE = "fp16" if device.type == "cuda" else "fp32"
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+if DTYPE != "fp32" and DTYPE not in AUTOCAST_DTYPES:
+    raise ValueError(f"Unsupported DTYPE for the classifier: {DTYPE!r} (expected auto, fp32, fp16 or bf16)")
+
+def autocast():
+    if DTYPE in AUTOCAST_DTYPES:
+        return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[DTYPE])
+    return contextlib.nullcontext()
+
+# CLASSIFIER_BACKEND=onnx exports the model once and serves it through ONNX Runtime
+BACKEND = os.getenv("CLASSIFIER_BACKEND", "torch")
+ONNX_PATH = os.getenv("ONNX_PATH", "./models/model.onnx")
+
+def load_onnx_session(model: nn.Module, onnx_path: str) -> ort.InferenceSession:
+    # the export is named after the checkpoint's hash, so a changed model.pth never serves stale weights
+    digest = hashlib.blake2b(digest_size=8)
+    with open(MODEL_PATH, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    root, ext = os.path.splitext(onnx_path)
+    onnx_path = f"{root}.{digest.hexdigest()}{ext}"
+    if not os.path.exists(onnx_path):
+        dummy = torch.randn(1, 3, 224, 224, device=device)
+        torch.onnx.export(
+            model, dummy, onnx_path,
+            opset_version=17,
+            input_names=["input"],
+            output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        )
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = ["CPUExecutionProvider"]
+    if device.type == "cuda":
+        providers.insert(0, "CUDAExecutionProvider")
+    return ort.InferenceSession(onnx_path, options, providers=providers)
+
+# on CUDA, compile the eager model: channels_last convs + CUDA graphs collapse the per-layer kernel launches
+TORCH_COMPILE_MODE = os.getenv("TORCH_COMPILE_MODE", "reduce-overhead")
+COMPILE_MODEL = BACKEND != "onnx" and device.type == "cuda" and TORCH_COMPILE_MODE != "none"
+
+def compile_model(model: nn.Module) -> nn.Module:
+    model = model.to(memory_format=torch.channels_last)
+    return torch.compile(model, mode=TORCH_COMPILE_MODE, fullgraph=True)
+
+# CUDA graph state is thread-local, so this runs once on every GPU executor thread
+def warmup_model(model: nn.Module):
+    if not COMPILE_MODEL:
+        return
+    dummy = torch.randn(1, 3, 224, 224, device=device).to(memory_format=torch.channels_last)
+    with torch.inference_mode(), autocast():
+        for _ in range(2):
+            model(dummy)
+
+def load_classifier():
+    model = load_model(MODEL_PATH, num_classes=len(CATEGORIES))
+    session = load_onnx_session(model, ONNX_PATH) if BACKEND == "onnx" else None
+    if COMPILE_MODEL:
+        model = compile_model(model)
+    return model, session
 
 # image preprocessing
 def preproc(image_bytes: bytes) -> Image.Image:
-    image = Image.open(BytesIO(image_bytes)).convert("RGB")
-    return image
-
-encode_image = T.Compose([
-        T.Resize(256),
-        T.CenterCrop(224),
-        T.RandomHorizontalFlip(),
-        T.RandomRotation(10),
-        T.ToTensor(),
-        T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    image = Image.open(BytesIO(image_bytes))
+    # JPEG only: let libjpeg decode at a reduced DCT scale that still covers Resize(256)
+    image.draft("RGB", (256, 256))
+    return image.convert("RGB")
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# resize/crop run on the uint8 image; only the 224x224 crop is converted to float
+encode_image = v2.Compose([
+        v2.Resize(256, antialias=True),
+        v2.CenterCrop(224),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(MEAN, STD)
     ])
 
+JPEG_MAGIC = b"\xff\xd8\xff"
 
-def classify(image: Image.Image) -> List[dict]:
-    img_tensor = encode_image(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        outputs = classifier(img_tensor)
-        probabilities = torch.nn.functional.softmax(outputs[0], dim=0)
+def encode(image_bytes: bytes) -> torch.Tensor:
+    image = None
+    if device.type == "cuda" and image_bytes[:3] == JPEG_MAGIC:
+        # nvJPEG decode: only the compressed bytes cross PCIe
+        data = torch.frombuffer(bytearray(image_bytes), dtype=torch.uint8)
+        try:
+            image = decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+        except RuntimeError:
+            pass  # fall back to PIL for JPEG variants nvJPEG rejects (CMYK, lossless, ...)
+    if image is None:
+        # on CUDA the H2D copy is the uint8 image, and the transform runs on the GPU
+        image = pil_to_tensor(preproc(image_bytes)).to(device)
+    return encode_image(image)
+
+
+def classify(image: torch.Tensor, state) -> List[dict]:
+    img_tensor = image.unsqueeze(0)
+    if COMPILE_MODEL:
+        img_tensor = img_tensor.contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode():
+        if state.ort_session is not None:
+            logits = state.ort_session.run(None, {"input": img_tensor.cpu().numpy()})[0]
+            outputs = torch.from_numpy(logits)
+        else:
+            with autocast():
+                outputs = state.classifier(img_tensor)
+        probabilities = torch.nn.functional.softmax(outputs[0].float(), dim=0)
         top3_prob, top3_catid = torch.topk(probabilities, 3)
-    results = []
-    for i in range(top3_prob.size(0)):
-        results.append({
-            "predicted": CATEGORIES[top3_catid[i]],
-            "confidence": top3_prob[i].item() * 100
-        })
-    return results
+    # a single device->host copy per tensor instead of one .item() sync per element
+    probs, ids = top3_prob.tolist(), top3_catid.tolist()
+    return [
+        {"predicted": CATEGORIES[i], "confidence": p * 100}
+        for p, i in zip(probs, ids)
+    ]
+
+# encode() decodes and transforms on the GPU, so it shares the forward's GPU slot
+def encode_and_classify(image_bytes: bytes, state) -> List[dict]:
+    return classify(encode(image_bytes), state)
+
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(8 * 1024 * 1024)))
+
+async def fetch_image(client: httpx.AsyncClient, url: str) -> bytes:
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        if not response.headers.get("content-type", "").startswith("image/"):
+            raise HTTPException(415, "Unsupported content-type")
+        if int(response.headers.get("content-length", 0)) > MAX_IMAGE_BYTES:
+            raise HTTPException(413, "Image too large")
+        content = bytearray()
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if len(content) > MAX_IMAGE_BYTES:
+                raise HTTPException(413, "Image too large")
+    return bytes(content)
 
 @app.post(
     "/classify/exec",
-    response_model=ClassifyRes,
+    response_model=None,
     summary="Classify image",
     description="Classify the given image URL.",
     tags=["Image Classification"],
     responses={
+        200: {"model": ClassifyRes},
+        413: {"description": "Image exceeds the maximum allowed size."},
         415: {"description": "Unsupported content-type. Only images are allowed."},
         500: {"description": "Error processing image."}
     }
 )
 async def classify_image(request: Request, body: ImageReq):
     try:
-        response = await request.app.state.http.get(body.image_url)
-        response.raise_for_status()
-        if not response.headers.get("content-type", "").startswith("image/"):
-            raise HTTPException(415, "Unsupported content-type")
-        img = preproc(response.content)
-        predictions = classify(img)
+        image_bytes = await fetch_image(request.app.state.http, body.image_url)
+        async with request.app.state.gpu_sem:
+            predictions = await asyncio.get_running_loop().run_in_executor(
+                request.app.state.gpu_executor, encode_and_classify, image_bytes, request.app.state
+            )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {e}")
 
     filename = body.image_url.split("/")[-1]
-    result = [AiPrediction(**pred) for pred in predictions]
-    return ClassifyRes(filename=filename, result=result)
+    # predictions are built by classify() itself, so they are serialized as-is; ClassifyRes only documents them
+    return ORJSONResponse({"filename": filename, "result": predictions})
 
 @app.get("/health", summary="Health Check", description="Check if the service is running.")
 async def health_check():
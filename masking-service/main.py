@@ -1,74 +1,154 @@
 import uvicorn
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import ORJSONResponse
 from io import BytesIO
-from PIL import Image, ImageDraw
-import easyocr
+from PIL import Image
+from cachetools import LRUCache, TTLCache
+import simplejpeg
 import numpy as np
-import boto3
+import aioboto3
+from aiobotocore.config import AioConfig
+from botocore.exceptions import BotoCoreError, ClientError
+import asyncio
+import contextlib
+import hashlib
 import os
-import uuid
+from ocr import (
+    AsyncBatcher, OcrPool, downscale, is_blank, mask_text, read_boxes_batched,
+    OCR_MAX_BATCH_SIZE, OCR_MAX_TASKS_PER_WORKER, OCR_MAX_WAIT_MS, OCR_POOL_SHARDS, OCR_WORKERS,
+)
+
+async def lifespan(app):
+    stack = contextlib.AsyncExitStack()
+    # one pooled, keep-alive S3 client reused across requests
+    app.state.s3 = await stack.enter_async_context(aioboto3.Session().client(
+        's3',
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=os.getenv("AWS_REGION"),
+        config=AioConfig(max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50")), tcp_keepalive=True)
+    ))
+    # stage gates: bound how many decoded images wait on OCR, and how many S3 PUTs run at once
+    app.state.ocr_sem = asyncio.Semaphore(int(os.getenv("OCR_MAX_PENDING", str(OCR_WORKERS * OCR_MAX_BATCH_SIZE))))
+    app.state.upload_sem = asyncio.Semaphore(int(os.getenv("S3_MAX_CONCURRENT_UPLOADS", "32")))
+    app.state.ocr_pool = OcrPool(OCR_WORKERS, OCR_MAX_TASKS_PER_WORKER, OCR_POOL_SHARDS)
+    app.state.ocr_batcher = AsyncBatcher(
+        lambda images: app.state.ocr_pool.run(read_boxes_batched, images),
+        OCR_MAX_BATCH_SIZE, OCR_MAX_WAIT_MS, concurrency=OCR_WORKERS,
+    )
+    worker = asyncio.create_task(app.state.ocr_batcher.run())
+    yield
+    worker.cancel()
+    app.state.ocr_pool.shutdown()
+    await stack.aclose()
 
 app=FastAPI(
     title="Image Masking Service",
     description="A FastAPI service for masking images using a pre-trained segmentation model.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
     docs_url="/mask/docs",
     redoc_url="/mask/redoc",
     openapi_url="/mask/openapi.json"
 )
 
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("AWS_REGION")
-)
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+# libwebp's hard limit on either side
+WEBP_MAX_SIDE = 16383
 
-reader = easyocr.Reader(['en', 'ko'])
-
-def mask_text(image: Image.Image) -> Image.Image:
-    image_np = np.array(image)
-    results = reader.readtext(image_np)
-
-    text_threshold = 0.3
-
-    filtered_boxes = [box for box, text, conf in results if conf >= text_threshold]
-
-    masked = image.copy()
-    draw = ImageDraw.Draw(masked)
-    for box in filtered_boxes:
-        polygon = [(int(point[0]), int(point[1])) for point in box]
-        draw.polygon(polygon, fill=(255, 255, 255))
+# OCR boxes keyed by a hash of the uploaded bytes; repeated uploads skip EasyOCR entirely
+ocr_cache = LRUCache(maxsize=int(os.getenv("OCR_CACHE_SIZE", "1024")))
+# S3 keys known to exist; masked images are stored under a hash of the upload, so hot keys skip even the HEAD
+uploaded_keys = TTLCache(maxsize=10_000, ttl=300)
 
-    return masked
+async def s3_object_exists(s3, key: str) -> bool:
+    if key in uploaded_keys:
+        return True
+    try:
+        await s3.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except ClientError:
+        # 404, or 403 when the role cannot list the bucket: treat as missing and (re)upload
+        return False
+    except BotoCoreError as e:
+        # endpoint unreachable, timeouts, bad credentials: the upload would fail too, so fail before OCR
+        raise HTTPException(status_code=500, detail=f"Failed to check S3 for masked image: {e}")
+    uploaded_keys[key] = True
+    return True
+
+async def upload_webp(s3, key: str, body: bytes):
+    # holds its upload slot until the PUT completes, even when the request awaiting it is cancelled
+    async with app.state.upload_sem:
+        await s3.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=body, ContentType="image/webp")
+    uploaded_keys[key] = True
+
+def decode_image(contents: bytes) -> np.ndarray:
+    # JPEGs go straight to an RGB array through libjpeg-turbo; other formats use PIL
+    if simplejpeg.is_jpeg(contents):
+        # simplejpeg skips PIL's decompression-bomb guard, so apply the same pixel cap from the header
+        height, width, _, _ = simplejpeg.decode_jpeg_header(contents)
+        if height * width > Image.MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError(f"Image size ({height * width} pixels) exceeds limit of {Image.MAX_IMAGE_PIXELS} pixels")
+        try:
+            return simplejpeg.decode_jpeg(contents, colorspace="RGB")
+        except ValueError:
+            pass  # fall back to PIL for JPEG variants simplejpeg rejects
+    image = Image.open(BytesIO(contents))
+    # convert() copies even when the mode already matches; np.array below is the one copy we need (writable)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.array(image)
+
+def decode_for_ocr(contents: bytes, need_ocr: bool):
+    # runs in a worker thread; the OCR input is None for cache hits and for blank images
+    image_np = decode_image(contents)
+    if not need_ocr or is_blank(image_np):
+        return image_np, None
+    return image_np, downscale(image_np)
+
+def encode_webp(image_np: np.ndarray) -> bytes:
+    buffer = BytesIO()
+    # lossy WebP: far smaller than PNG and cheaper to encode
+    Image.fromarray(image_np).save(buffer, format="WEBP", quality=85, method=4)
+    return buffer.getvalue()
 
 @app.post("/mask/exec", summary="Mask text in image and upload to S3", description="Upload an image, mask text, and upload the masked image to AWS S3.")
 async def mask_image(file: UploadFile = File(...)):
     if not S3_BUCKET_NAME:
         raise HTTPException(status_code=500, detail="S3_BUCKET_NAME environment variable not set.")
 
-    try:
-        contents = await file.read()
-        img = Image.open(BytesIO(contents)).convert("RGB")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error reading image file: {e}")
-
-    masked_img = mask_text(img)
-
-    # Save masked image to a BytesIO object
-    masked_img_buffer = BytesIO()
-    masked_img.save(masked_img_buffer, format="PNG")
-    masked_img_buffer.seek(0) # Rewind the buffer to the beginning
-
-    # Generate a unique filename for S3
-    file_extension = file.filename.split(".")[-1] if "." in file.filename else "png"
-    s3_filename = f"masked_images/{uuid.uuid4()}.{file_extension}"
+    contents = await file.read()
+    digest = hashlib.blake2b(contents, digest_size=16)
+
+    # identical uploads map to the same object, so a duplicate costs one HEAD (or nothing, if cached)
+    s3_filename = f"masked_images/{digest.hexdigest()}.webp"
+    s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_filename}"
+    if await s3_object_exists(app.state.s3, s3_filename):
+        return {"message": "Masking and upload completed successfully", "s3_url": s3_url}
+
+    # every stage awaits, so downloads, OCR and uploads of different requests overlap on the loop
+    async with app.state.ocr_sem:
+        cache_key = digest.digest()
+        boxes = ocr_cache.get(cache_key)
+        try:
+            image_np, ocr_input = await asyncio.to_thread(decode_for_ocr, contents, boxes is None)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error reading image file: {e}")
+        if max(image_np.shape[:2]) > WEBP_MAX_SIDE:
+            raise HTTPException(status_code=413, detail=f"Image sides must not exceed {WEBP_MAX_SIDE} pixels.")
+
+        if boxes is None:
+            boxes = [] if ocr_input is None else await app.state.ocr_batcher.submit(ocr_input)
+            ocr_cache[cache_key] = boxes
+        try:
+            masked_webp = await asyncio.to_thread(encode_webp, mask_text(image_np, boxes))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error encoding masked image: {e}")
+    del image_np
 
     try:
-        s3_client.upload_fileobj(masked_img_buffer, S3_BUCKET_NAME, s3_filename)
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_filename}"
+        # shield: a client disconnect does not abort the upload, whether it is still queued or in flight
+        await asyncio.shield(upload_webp(app.state.s3, s3_filename, masked_webp))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload masked image to S3: {e}")
 
@@ -79,4 +159,4 @@ async def health_check():
     return {"status": "ok"}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8003)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8003, workers=int(os.getenv("WEB_CONCURRENCY", "1")))
\ No newline at end of file
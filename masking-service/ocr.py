@@ -0,0 +1,228 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple
+import easyocr
+import onnxruntime as ort
+import cv2
+import numpy as np
+import torch
+import asyncio
+import multiprocessing
+import os
+
+# OCR worker processes: by default the usable cores are split evenly between the uvicorn workers
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+CPU_COUNT = len(os.sched_getaffinity(0))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(max(1, CPU_COUNT // WEB_CONCURRENCY))))
+OCR_MAX_TASKS_PER_WORKER = int(os.getenv("OCR_MAX_TASKS_PER_WORKER", "200"))
+OCR_POOL_SHARDS = int(os.getenv("OCR_POOL_SHARDS", "2"))
+
+# OCR_BACKEND=onnx runs the CRAFT detector through ONNX Runtime instead of eager PyTorch
+OCR_BACKEND = os.getenv("OCR_BACKEND", "torch")
+DETECTOR_ONNX_PATH = os.getenv("DETECTOR_ONNX_PATH", "./craft.onnx")
+
+reader = None
+
+class OnnxDetector:
+    # drop-in for reader.detector: easyocr calls it as `y, feature = net(x)` on a [B, 3, H, W] tensor
+    def __init__(self, session: ort.InferenceSession):
+        self.session = session
+
+    def __call__(self, x: torch.Tensor):
+        y, feature = self.session.run(None, {"image": x.cpu().numpy()})
+        return torch.from_numpy(y), torch.from_numpy(feature)
+
+def export_detector(detector: torch.nn.Module, onnx_path: str):
+    # every worker may race to export on first start; write to a private file and rename atomically
+    tmp_path = f"{onnx_path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        detector, torch.randn(1, 3, 640, 640), tmp_path,
+        opset_version=17,
+        input_names=["image"],
+        output_names=["y", "feature"],
+        dynamic_axes={
+            "image": {0: "batch", 2: "height", 3: "width"},
+            "y": {0: "batch", 1: "out_height", 2: "out_width"},
+            "feature": {0: "batch", 2: "out_height", 3: "out_width"},
+        },
+    )
+    os.replace(tmp_path, onnx_path)
+
+def load_onnx_detector(detector: torch.nn.Module, num_threads: int) -> OnnxDetector:
+    onnx_path = DETECTOR_ONNX_PATH
+    if not os.path.exists(onnx_path):
+        export_detector(detector, onnx_path)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = num_threads
+    session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+    return OnnxDetector(session)
+
+def init_reader():
+    global reader
+    # cores are shared by the OCR processes of every uvicorn worker
+    num_threads = max(1, CPU_COUNT // (OCR_WORKERS * WEB_CONCURRENCY))
+    torch.set_num_threads(num_threads)
+    # weights are downloaded once ahead of time (see Dockerfile), never by the workers
+    reader = easyocr.Reader(['en', 'ko'], gpu=False, quantize=True, download_enabled=False)
+    if OCR_BACKEND == "onnx":
+        reader.detector = load_onnx_detector(reader.detector, num_threads)
+
+class OcrPool:
+    # shards are recycled one at a time to free readtext's leaked memory; RSS peaks near 1 + 1/shards pools
+    def __init__(self, workers: int, max_tasks_per_worker: int, shards: int = 2):
+        shards = max(1, min(shards, workers))
+        self.sizes = [workers // shards + (i < workers % shards) for i in range(shards)]
+        self.max_tasks = [size * max_tasks_per_worker for size in self.sizes]
+        # offset the counters so the shards come due for recycling at different times
+        self.tasks = [i * limit // shards for i, limit in enumerate(self.max_tasks)]
+        self.inflight = [0] * shards
+        self.executors = [self._new_executor(size) for size in self.sizes]
+
+    def _new_executor(self, workers: int) -> ProcessPoolExecutor:
+        # spawn, not fork: the server process already runs an event loop and worker threads
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_reader,
+        )
+
+    def _recycle(self, shard: int):
+        # in-flight batches finish on the old processes, which then exit
+        self.executors[shard].shutdown(wait=False)
+        self.executors[shard] = self._new_executor(self.sizes[shard])
+        self.tasks[shard] = 0
+
+    async def run(self, fn, *args):
+        # least busy shard first, so batches avoid a shard that is still cold-starting
+        shard = min(range(len(self.executors)), key=self.inflight.__getitem__)
+        if self.tasks[shard] >= self.max_tasks[shard]:
+            self._recycle(shard)
+        self.tasks[shard] += 1
+        self.inflight[shard] += 1
+        loop = asyncio.get_running_loop()
+        executor = self.executors[shard]
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # a worker died (OOM kill, failed init): rebuild the shard once and retry this batch
+            if self.executors[shard] is executor:
+                self._recycle(shard)
+            return await loop.run_in_executor(self.executors[shard], fn, *args)
+        finally:
+            self.inflight[shard] -= 1
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+TEXT_THRESHOLD = 0.3
+OCR_MAX_BATCH_SIZE = int(os.getenv("OCR_MAX_BATCH_SIZE", "8"))
+OCR_MAX_WAIT_MS = float(os.getenv("OCR_MAX_WAIT_MS", "15"))
+# detection cost is O(W*H) and masking is scale-tolerant, so OCR runs on a copy capped at this long side
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "1280"))
+
+# images below this size, or whose thumbnail spans less than this intensity range, hold no text to mask
+MIN_OCR_PIXELS = 64 * 64
+BLANK_RANGE_THRESHOLD = int(os.getenv("OCR_BLANK_RANGE_THRESHOLD", "16"))
+
+def is_blank(image: np.ndarray) -> bool:
+    height, width = image.shape[:2]
+    if height * width < MIN_OCR_PIXELS:
+        return True
+    # area-average to ~1/8 scale: unlike strided sampling this cannot step over thin strokes
+    thumbnail = cv2.resize(image, (max(1, width // 8), max(1, height // 8)), interpolation=cv2.INTER_AREA)
+    # per channel: a flat coloured canvas has a wide range across channels but none within one
+    return int(np.ptp(thumbnail.reshape(-1, thumbnail.shape[-1]), axis=0).max()) < BLANK_RANGE_THRESHOLD
+
+def downscale(image: np.ndarray):
+    scale = max(image.shape[:2]) / OCR_MAX_SIDE
+    if scale <= 1:
+        return image, 1.0
+    size = (int(image.shape[1] / scale), int(image.shape[0] / scale))
+    # INTER_AREA averages every source pixel, so 1 px strokes survive the shrink (INTER_LINEAR drops them)
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+def read_boxes_batched(items: List[Tuple[np.ndarray, float]]) -> List[list]:
+    # items are (downscaled image, scale) pairs, downscaled in the server process
+    images, scales = zip(*items)
+
+    # pad bottom/right with white so the detector runs once on the batch; box coordinates are unchanged
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+    padded = []
+    for image in images:
+        if image.shape[:2] != (height, width):
+            canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+            canvas[:image.shape[0], :image.shape[1]] = image
+            image = canvas
+        padded.append(image)
+
+    # images are already capped, so keep EasyOCR from magnifying them again
+    results = reader.readtext_batched(padded, canvas_size=OCR_MAX_SIDE, mag_ratio=1.0)
+    return [
+        [
+            tuple((int(x * scale), int(y * scale)) for x, y in box)
+            for box, text, conf in result if conf >= TEXT_THRESHOLD
+        ]
+        for result, scale in zip(results, scales)
+    ]
+
+
+class AsyncBatcher:
+    def __init__(self, fn, max_batch_size: int, max_wait_ms: float, concurrency: int = 1):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(concurrency)
+        self.running = set()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            # up to `concurrency` batches in flight; later arrivals accumulate into the next batch
+            await self.slots.acquire()
+            task = asyncio.create_task(self._run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run_batch(self, batch: list):
+        try:
+            results = await self.fn([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+def mask_text(image_np: np.ndarray, filtered_boxes: list) -> np.ndarray:
+    # fills the text polygons in place
+    if filtered_boxes:
+        polygons = [np.asarray(box, dtype=np.int32) for box in filtered_boxes]
+        cv2.fillPoly(image_np, polygons, (255, 255, 255))
+    return image_np